@@ -2,25 +2,33 @@
 
 import os
 import yt_dlp
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Form
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Form, Query
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import re
+import json
 from urllib.parse import urlparse, parse_qs
 import time
 from datetime import datetime, timedelta
 import uuid
+import random
+from functools import lru_cache
 import asyncio
 from typing import Dict, Optional, Any
 import logging
 from enum import Enum
+from collections import Counter
+from itertools import islice
 import tempfile
-import shutil
+import mimetypes
 import threading
+import multiprocessing
 import glob
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import weakref
 import psutil
 import signal
@@ -30,6 +38,14 @@ import sys
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Precompiled URL patterns (one pass per check instead of one per shape)
+_YT_URL_RE = re.compile(
+    r'^(?:https?://)?(?:(?:www\.|m\.|music\.)?youtube\.com/(?:watch\?v=|shorts/|embed/|v/)|youtu\.be/)[A-Za-z0-9_-]{11}'
+)
+_YT_ID_RE = re.compile(r'(?:v=|/)([0-9A-Za-z_-]{11})')
+_CANONICAL_RE = re.compile(r'^https://www\.youtube\.com/watch\?v=[\w-]{11}$')
+_YT_HOSTS = frozenset(('www.youtube.com', 'youtube.com', 'm.youtube.com'))
+
 # Task status enum
 class TaskStatus(str, Enum):
     PENDING = "pending"
@@ -41,14 +57,15 @@ class TaskStatus(str, Enum):
 # ✅ ENHANCED TASK MANAGER FOR LONG VIDEOS
 class TaskManager:
     def __init__(self):
-        self.tasks: Dict[str, Dict] = {}
+        self.tasks: Dict[str, Dict] = {}  # Insertion ordered, oldest first
+        self._status_counts = Counter()  # Kept in step with task status changes
         self.cleanup_interval = 7200  # 2 hours for long videos
-        self._lock = threading.RLock()
+        self._lock = threading.Lock()
         self.max_concurrent_downloads = 3  # Limit concurrent downloads
-        self.active_downloads = 0
         
     def create_task(self, task_id: str, url: str, format_id: str, quality: str) -> str:
         """Create a new download task"""
+        now = datetime.now()
         with self._lock:
             self.tasks[task_id] = {
                 "id": task_id,
@@ -61,8 +78,8 @@ class TaskManager:
                 "filename": None,
                 "download_url": None,
                 "error": None,
-                "created_at": datetime.now(),
-                "updated_at": datetime.now(),
+                "created_at": now,
+                "updated_at": now,
                 "download_speed": "0 B/s",
                 "eta": "Unknown",
                 "file_size": "Unknown",
@@ -71,34 +88,43 @@ class TaskManager:
                 "retry_count": 0,
                 "max_retries": 5
             }
+            self._status_counts[TaskStatus.PENDING] += 1
         return task_id
     
     def update_task(self, task_id: str, **kwargs):
         """Update task information"""
         with self._lock:
             if task_id in self.tasks:
-                self.tasks[task_id].update(kwargs)
-                self.tasks[task_id]["updated_at"] = datetime.now()
+                task = self.tasks[task_id]
+                if "status" in kwargs and kwargs["status"] != task["status"]:
+                    self._status_counts[task["status"]] -= 1
+                    self._status_counts[kwargs["status"]] += 1
+                task.update(kwargs)
+                task["updated_at"] = datetime.now()
     
     def get_task(self, task_id: str) -> Optional[Dict]:
         """Get task information"""
         with self._lock:
             return self.tasks.get(task_id)
     
-    def can_start_download(self) -> bool:
-        """Check if we can start a new download"""
+    def delete_task(self, task_id: str) -> bool:
+        """Delete a task, returning False if it doesn't exist"""
         with self._lock:
-            return self.active_downloads < self.max_concurrent_downloads
+            task = self.tasks.pop(task_id, None)
+            if task is None:
+                return False
+            self._status_counts[task["status"]] -= 1
+            return True
     
-    def increment_active_downloads(self):
-        """Increment active download counter"""
+    def list_tasks(self, limit: int, offset: int = 0) -> list:
+        """Get a page of tasks without copying the whole task list"""
         with self._lock:
-            self.active_downloads += 1
+            return list(islice(self.tasks.values(), offset, offset + limit))
     
-    def decrement_active_downloads(self):
-        """Decrement active download counter"""
+    def status_count(self, status: TaskStatus) -> int:
+        """Get the number of tasks currently in a status"""
         with self._lock:
-            self.active_downloads = max(0, self.active_downloads - 1)
+            return self._status_counts[status]
     
     def cleanup_old_tasks(self):
         """Remove old completed/failed tasks"""
@@ -112,7 +138,7 @@ class TaskManager:
                     to_remove.append(task_id)
             
             for task_id in to_remove:
-                del self.tasks[task_id]
+                self._status_counts[self.tasks.pop(task_id)["status"]] -= 1
                 logger.info(f"Cleaned up old task: {task_id}")
 
 # Pydantic models
@@ -139,22 +165,71 @@ app.mount("/images", StaticFiles(directory="images"), name="images")
 # Initialize task manager
 task_manager = TaskManager()
 
+def _fast_rmtree(path):
+    """Remove a directory tree using scandir's cached entry types"""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+_CONTENT_TYPES = {
+    '.mp4': 'video/mp4',
+    '.mp3': 'audio/mpeg',
+    '.webm': 'video/webm',
+    '.m4a': 'audio/mp4',
+}
+
+def guess_content_type(filename):
+    """Get the media type to serve a downloaded file with"""
+    ext = os.path.splitext(filename)[1].lower()
+    return _CONTENT_TYPES.get(ext) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+# Dedicated root for download dirs, so sweep() only ever scans this app's
+# own dirs rather than the whole system temp dir
+TEMP_ROOT = os.path.join(tempfile.gettempdir(), 'youtube_dl')
+TEMP_DIR_PREFIX = 'youtube_dl_long_'
+
 # ✅ ENHANCED FILE MANAGER FOR LARGE FILES
 class FileManager:
     def __init__(self):
         self._files = {}
-        self._lock = threading.RLock()
+        self._temp_dirs: Dict[str, str] = {}  # temp dir name -> task_id
+        self._lock = threading.Lock()
         self.max_file_age = 3600  # 1 hour for large files
     
-    def register_file(self, task_id: str, file_path: str, temp_dir: str):
-        """Register a file for tracking and cleanup"""
+    def create_temp_dir(self, task_id: str) -> str:
+        """Create and track a temp directory for a download"""
+        # The pid in the name tells sweep() which server process owns it.
+        # The root is (re)created here since tmp cleaners may remove it
+        os.makedirs(TEMP_ROOT, exist_ok=True)
+        with self._lock:
+            temp_dir = tempfile.mkdtemp(prefix=f"{TEMP_DIR_PREFIX}{os.getpid()}_", dir=TEMP_ROOT)
+            self._temp_dirs[os.path.basename(temp_dir)] = task_id
+        return temp_dir
+    
+    def discard_temp_dir(self, temp_dir: str):
+        """Stop tracking and delete the temp directory of a failed download"""
+        with self._lock:
+            self._temp_dirs.pop(os.path.basename(temp_dir), None)
+        try:
+            _fast_rmtree(temp_dir)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error cleaning up {temp_dir}: {e}")
+    
+    def register_file(self, task_id: str, file_path: str, temp_dir: str, file_size: int):
+        """Register a file for tracking and cleanup (size as stat'ed by the worker)"""
         with self._lock:
-            file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
             self._files[task_id] = {
                 'file_path': file_path,
                 'temp_dir': temp_dir,
                 'filename': os.path.basename(file_path),
-                'created_at': datetime.now(),
+                'content_type': guess_content_type(file_path),
+                'created_at': time.monotonic(),
                 'downloaded': False,
                 'file_size': file_size,
                 'access_count': 0
@@ -175,39 +250,243 @@ class FileManager:
     def cleanup_file(self, task_id: str):
         """Clean up a specific file"""
         with self._lock:
-            if task_id in self._files:
-                file_info = self._files[task_id]
-                try:
-                    if os.path.exists(file_info['temp_dir']):
-                        shutil.rmtree(file_info['temp_dir'])
-                        logger.info(f"Cleaned up temp directory: {file_info['temp_dir']}")
-                except Exception as e:
-                    logger.error(f"Error cleaning up {task_id}: {e}")
-                finally:
-                    del self._files[task_id]
+            file_info = self._files.pop(task_id, None)
+            if file_info is None:
+                return
+            self._temp_dirs.pop(os.path.basename(file_info['temp_dir']), None)
+        
+        # Delete outside the lock so a multi-GB tree doesn't stall callers
+        try:
+            _fast_rmtree(file_info['temp_dir'])
+            logger.info(f"Cleaned up temp directory: {file_info['temp_dir']}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error cleaning up {task_id}: {e}")
     
     def cleanup_old_files(self):
         """Clean up old downloaded files"""
-        current_time = datetime.now()
+        current_time = time.monotonic()
         to_cleanup = []
         
         with self._lock:
             for task_id, file_info in self._files.items():
-                age = (current_time - file_info['created_at']).total_seconds()
+                age = current_time - file_info['created_at']
                 # Clean up files older than max_file_age or accessed files older than 10 minutes
                 if age > self.max_file_age or (file_info['downloaded'] and age > 600):
                     to_cleanup.append(task_id)
         
         for task_id in to_cleanup:
             self.cleanup_file(task_id)
+    
+    def sweep(self):
+        """Clean up old files plus orphaned temp dirs in one pass over TEMP_ROOT"""
+        self.cleanup_old_files()
+        
+        try:
+            with os.scandir(TEMP_ROOT) as it:
+                candidates = [entry for entry in it if entry.name.startswith(TEMP_DIR_PREFIX)]
+        except FileNotFoundError:
+            return  # No download has created the root yet, or it was removed
+        
+        with self._lock:
+            # Membership is checked under the lock so a dir being created
+            # by create_temp_dir is never mistaken for an orphan
+            orphans = [entry for entry in candidates if entry.name not in self._temp_dirs]
+        
+        my_pid = os.getpid()
+        for entry in orphans:
+            owner_pid = int(entry.name[len(TEMP_DIR_PREFIX):].split('_', 1)[0])
+            # Other live server processes manage their own dirs
+            if owner_pid != my_pid and psutil.pid_exists(owner_pid):
+                continue
+            try:
+                _fast_rmtree(entry.path)
+                logger.info(f"Cleaned up orphaned temp directory: {entry.path}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error cleaning up {entry.path}: {e}")
 
 # Initialize file manager
 file_manager = FileManager()
-executor = ThreadPoolExecutor(max_workers=5)  # Reduced for stability
+
+# ✅ ADAPTIVE CHUNK SIZING FROM MEASURED THROUGHPUT
+MIN_CHUNK_SIZE = 1 << 20   # 1 MiB
+MAX_CHUNK_SIZE = 64 << 20  # 64 MiB
+CHUNK_REQUEST_OVERHEAD = 0.2  # Assumed per-request setup cost in seconds
+CHUNK_EFFICIENCY_EPS = 0.05   # Max fraction of each chunk spent on setup
+
+class BandwidthEstimator:
+    def __init__(self, alpha: float = 0.9):
+        # EWMA over seconds-per-byte, i.e. a smoothed harmonic mean of
+        # throughput, so one fast sample can't inflate the estimate.
+        # Kept as one estimate for the server's uplink: the media edge
+        # host differs per video and isn't known before a download starts
+        self.alpha = alpha
+        self._inverse: Optional[float] = None
+    
+    def record(self, num_bytes: float, elapsed: float):
+        """Record a completed transfer"""
+        if not num_bytes or not elapsed or elapsed <= 0:
+            return
+        sample = elapsed / num_bytes
+        if self._inverse is None:
+            self._inverse = sample
+        else:
+            self._inverse = self.alpha * self._inverse + (1 - self.alpha) * sample
+    
+    def estimate(self) -> Optional[float]:
+        """Get estimated throughput in bytes per second"""
+        return 1 / self._inverse if self._inverse else None
+    
+    def chunk_size(self) -> Optional[int]:
+        """Smallest chunk keeping per-request overhead under CHUNK_EFFICIENCY_EPS"""
+        rate = self.estimate()
+        if rate is None:
+            return None
+        size = int(rate * CHUNK_REQUEST_OVERHEAD / CHUNK_EFFICIENCY_EPS)
+        return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+
+# Initialize bandwidth estimator (only used from the event loop)
+bandwidth_estimator = BandwidthEstimator()
+PROGRESS_UPDATE_INTERVAL = 0.25  # Seconds between progress updates per task
+MAX_RETRY_DELAY = 30  # Cap on backoff between download attempts
+MAX_RETRY_AFTER = 300  # Cap on a server-requested Retry-After
+# Current desktop browser user agents, one picked per download (an
+# outdated fixed UA is more likely to be served throttled bandwidth)
+_UA_POOL = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:131.0) Gecko/20100101 Firefox/131.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.0 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36 Edg/129.0.0.0',
+)
+# YouTube player clients to query, in order; shared by extraction and
+# downloads so both see the same formats
+PLAYER_CLIENTS = [c.strip() for c in os.environ.get('YDL_PLAYER_CLIENTS', 'ios,web').split(',') if c.strip()]
+_EXTRACTOR_ARGS = {'youtube': {'player_client': PLAYER_CLIENTS}}
+# Parallel fragment downloads per file (network-bound, so not tied to the
+# CPU count; tunable without a code change)
+CONCURRENT_FRAGMENTS = int(os.environ.get('YDL_CONCURRENT_FRAGS', 8))
+
+# Dedicated process pool for yt-dlp info extraction (keeps the default
+# thread pool free and runs the pure-Python parsing on separate cores).
+# The pools themselves are created per worker in startup_event.
+EXTRACT_WORKERS = min(os.cpu_count() or 1, 4)
+_extract_sem = asyncio.BoundedSemaphore(EXTRACT_WORKERS)
+
+@lru_cache(maxsize=8)
+def _get_ydl(opts_key):
+    """Get a YoutubeDL instance reused across calls with the same options"""
+    # Cached per pool worker process, which only runs one job at a time
+    return yt_dlp.YoutubeDL(json.loads(opts_key))
+
+def _extract_info_sync(url, ydl_opts):
+    """Synchronous info extraction for the process pool"""
+    # Options hold nested dicts (extractor_args), so key the cache on JSON
+    ydl = _get_ydl(json.dumps(ydl_opts, sort_keys=True))
+    info = ydl.extract_info(url, download=False)
+    # Strip non-picklable values before crossing the process boundary
+    return ydl.sanitize_info(info)
+
+# Short-lived cache of the metadata a download needs (title, duration) so
+# it can reuse what /extract fetched instead of hitting YouTube again. The
+# full info dict (every format URL, captions, thumbnails) is not kept.
+INFO_CACHE_TTL = 300  # 5 minutes
+_INFO_CACHE: Dict[str, tuple] = {}  # video_id -> (timestamp, title, duration)
+
+def _evict_expired_info(now):
+    for key in [k for k, entry in _INFO_CACHE.items() if now - entry[0] > INFO_CACHE_TTL]:
+        del _INFO_CACHE[key]
+
+def cache_video_info(video_id, title, duration):
+    """Store a video's title and duration, evicting expired entries"""
+    now = time.monotonic()
+    _evict_expired_info(now)
+    _INFO_CACHE[video_id] = (now, title, duration)
+
+def get_cached_video_info(video_id):
+    """Return a cached (title, duration) for a video if it has not expired"""
+    _evict_expired_info(time.monotonic())
+    entry = _INFO_CACHE.get(video_id)
+    return entry[1:] if entry else None
+
+# Rough size estimates in MB per minute of video
+_BITRATES = {
+    1080: 8,   # 8 MB per minute
+    720: 5,    # 5 MB per minute
+    480: 3     # 3 MB per minute
+}
+
+# Static fields of the formats offered by /extract; per-request fields
+# (quality label, recommended, estimated_size) are filled in on a copy
+_FORMAT_TEMPLATES = {
+    1080: {
+        'format_id': 'best[height>=1080]',
+        'height': 1080,
+        'width': 1920,
+        'ext': 'mp4',
+        'filesize': 0,
+        'fps': 30,
+        'has_audio': True,
+        'vcodec': 'h264',
+        'acodec': 'aac',
+    },
+    720: {
+        'format_id': 'best[height>=720]',
+        'height': 720,
+        'width': 1280,
+        'ext': 'mp4',
+        'filesize': 0,
+        'fps': 30,
+        'has_audio': True,
+        'vcodec': 'h264',
+        'acodec': 'aac',
+    },
+    480: {
+        'format_id': 'best[height>=480]',
+        'quality': 'HD (480p) - Good Quality ⚡ Fastest download',
+        'height': 480,
+        'width': 854,
+        'ext': 'mp4',
+        'filesize': 0,
+        'fps': 30,
+        'has_audio': True,
+        'vcodec': 'h264',
+        'acodec': 'aac',
+    },
+    'best': {
+        'format_id': 'best',
+        'quality': 'Best Available Quality (Auto) 🔄 Adaptive',
+        'height': 720,
+        'width': 1280,
+        'ext': 'mp4',
+        'filesize': 0,
+        'fps': 30,
+        'has_audio': True,
+        'vcodec': 'h264',
+        'acodec': 'aac',
+    },
+    'audio': {
+        'format_id': 'bestaudio',
+        'quality': '🎵 Audio Only (320kbps MP3) 📱 Mobile friendly',
+        'height': 0,
+        'width': 0,
+        'ext': 'mp3',
+        'filesize': 0,
+        'fps': 0,
+        'has_audio': True,
+        'vcodec': 'none',
+        'acodec': 'mp3',
+    },
+}
+
+_TITLE_TRANS = str.maketrans({c: "_" for c in '\\/*?:"<>|'})
 
 def sanitize_title(title):
     """Sanitize title for filename"""
-    return re.sub(r'[\\/*?:"<>|]', "_", title)
+    return title.translate(_TITLE_TRANS)
 
 # Create necessary directories
 os.makedirs('static', exist_ok=True)
@@ -215,64 +494,52 @@ os.makedirs('templates', exist_ok=True)
 
 class YouTubeDownloader:
     def __init__(self):
-        self.download_semaphore = asyncio.Semaphore(3)  # Limit concurrent downloads
+        self.download_semaphore = asyncio.Semaphore(task_manager.max_concurrent_downloads)  # Limit concurrent downloads
+        self.active_downloads = 0  # Only touched from the event loop
     
     def is_valid_youtube_url(self, url):
         """Validate if the URL is a valid YouTube video URL"""
-        youtube_patterns = [
-            r'https?://(?:www\.)?youtube\.com/watch\?v=[\w-]+',
-            r'https?://(?:www\.)?youtube\.com/embed/[\w-]+',
-            r'https?://youtu\.be/[\w-]+',
-            r'https?://(?:m\.)?youtube\.com/watch\?v=[\w-]+',
-            r'https?://(?:www\.)?youtube\.com/v/[\w-]+',
-            r'https?://(?:www\.)?youtube\.com/shorts/[\w-]+'
-        ]
-        
-        for pattern in youtube_patterns:
-            if re.match(pattern, url):
-                return True
-        return False
+        return _YT_URL_RE.match(url) is not None
     
     def extract_video_id(self, url):
         """Extract video ID from YouTube URL"""
-        patterns = [
-            r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-            r'(?:embed\/)([0-9A-Za-z_-]{11})',
-            r'(?:shorts\/)([0-9A-Za-z_-]{11})'
-        ]
+        parsed = urlparse(url)
+        if parsed.hostname in _YT_HOSTS:
+            if parsed.path == '/watch':
+                video_id = parse_qs(parsed.query).get('v', [None])[0]
+                if video_id:
+                    return video_id[:11]
+            else:
+                parts = parsed.path.strip('/').split('/', 1)
+                if parts[0] in ('embed', 'v', 'shorts') and len(parts) > 1:
+                    return parts[1][:11]
+        elif parsed.hostname == 'youtu.be':
+            return parsed.path.lstrip('/')[:11] or None
         
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
-        return None
+        # Uncommon shapes fall back to the regex
+        match = _YT_ID_RE.search(url)
+        return match.group(1) if match else None
     
-    def get_unique_filename(self, base_path, title, ext):
-        """Generate unique filename to avoid conflicts"""
-        safe_title = sanitize_title(title)
-        base_filename = f"{safe_title}.{ext}"
-        full_path = os.path.join(base_path, base_filename)
-        
-        if not os.path.exists(full_path):
-            return base_filename
+    def clean_url(self, url):
+        """Return (video_id, canonical watch URL) for a YouTube URL"""
+        # URLs that are already canonical skip ID extraction entirely
+        if _CANONICAL_RE.match(url):
+            return url[-11:], url
         
-        counter = 1
-        while True:
-            new_filename = f"{safe_title}_{counter}.{ext}"
-            new_full_path = os.path.join(base_path, new_filename)
-            if not os.path.exists(new_full_path):
-                return new_filename
-            counter += 1
+        video_id = self.extract_video_id(url)
+        if video_id:
+            return video_id, f"https://www.youtube.com/watch?v={video_id}"
+        return None, url
+    
+    def get_unique_filename(self, title, ext):
+        """Generate filename (unique since each task has its own mkdtemp dir)"""
+        return f"{sanitize_title(title)}.{ext}"
     
     async def extract_video_info(self, url):
         """Extract video information using yt-dlp"""
         try:
             # Clean URL
-            video_id = self.extract_video_id(url)
-            if video_id:
-                clean_url = f"https://www.youtube.com/watch?v={video_id}"
-            else:
-                clean_url = url
+            video_id, clean_url = self.clean_url(url)
             
             # ✅ OPTIMIZED YT-DLP OPTIONS FOR LONG VIDEOS
             ydl_opts = {
@@ -286,18 +553,23 @@ class YouTubeDownloader:
                 'skip_unavailable_fragments': True,
                 'keep_fragments': False,
                 'http_chunk_size': 10485760,  # 10MB chunks
+                'extractor_args': _EXTRACTOR_ARGS,
             }
             
             logger.info(f"Extracting info for: {clean_url}")
             
-            # Run in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(
-                None, 
-                self._extract_info_sync, 
-                clean_url, 
-                ydl_opts
-            )
+            # Run in the extraction process pool to avoid blocking
+            async with _extract_sem:
+                info = await run_in_pool(
+                    'extract_pool',
+                    _extract_info_sync,
+                    clean_url,
+                    ydl_opts,
+                    retry=True
+                )
+            
+            if video_id:
+                cache_video_info(video_id, info.get('title'), info.get('duration') or 0)
             
             logger.info(f"Video title: {info.get('title', 'Unknown')}")
             logger.info(f"Duration: {info.get('duration', 0)} seconds")
@@ -323,9 +595,15 @@ class YouTubeDownloader:
             
             # Check available formats
             available_formats = info.get('formats', [])
-            has_1080p = any(f.get('height', 0) >= 1080 for f in available_formats if f.get('vcodec') != 'none')
-            has_720p = any(f.get('height', 0) >= 720 for f in available_formats if f.get('vcodec') != 'none')
-            has_480p = any(f.get('height', 0) >= 480 for f in available_formats if f.get('vcodec') != 'none')
+            max_height = 0
+            for f in available_formats:
+                if f.get('vcodec') != 'none':
+                    height = f.get('height') or 0
+                    if height > max_height:
+                        max_height = height
+            has_1080p = max_height >= 1080
+            has_720p = max_height >= 720
+            has_480p = max_height >= 480
             
             logger.info(f"Available qualities - 1080p: {has_1080p}, 720p: {has_720p}, 480p: {has_480p}")
             
@@ -333,83 +611,35 @@ class YouTubeDownloader:
             
             # ✅ OPTIMIZED FORMAT SELECTION FOR LONG VIDEOS
             if has_1080p:
-                formats.append({
-                    'format_id': 'best[height>=1080]',
-                    'quality': f'Ultra HD (1080p) - Best Quality {"⚠️ Large file for long videos" if is_long_video else ""}',
-                    'height': 1080,
-                    'width': 1920,
-                    'ext': 'mp4',
-                    'filesize': 0,
-                    'fps': 30,
-                    'has_audio': True,
-                    'vcodec': 'h264',
-                    'acodec': 'aac',
-                    'recommended': not is_long_video,  # Not recommended for very long videos
-                    'estimated_size': self._estimate_file_size(duration, 1080)
-                })
+                fmt = _FORMAT_TEMPLATES[1080].copy()
+                fmt['quality'] = f'Ultra HD (1080p) - Best Quality {"⚠️ Large file for long videos" if is_long_video else ""}'
+                fmt['recommended'] = not is_long_video  # Not recommended for very long videos
+                fmt['estimated_size'] = self._estimate_file_size(duration, 1080)
+                formats.append(fmt)
             
             if has_720p:
-                formats.append({
-                    'format_id': 'best[height>=720]',
-                    'quality': f'Full HD (720p) - High Quality {"✅ Recommended for long videos" if is_long_video else ""}',
-                    'height': 720,
-                    'width': 1280,
-                    'ext': 'mp4',
-                    'filesize': 0,
-                    'fps': 30,
-                    'has_audio': True,
-                    'vcodec': 'h264',
-                    'acodec': 'aac',
-                    'recommended': is_long_video or not has_1080p,  # Recommended for long videos
-                    'estimated_size': self._estimate_file_size(duration, 720)
-                })
+                fmt = _FORMAT_TEMPLATES[720].copy()
+                fmt['quality'] = f'Full HD (720p) - High Quality {"✅ Recommended for long videos" if is_long_video else ""}'
+                fmt['recommended'] = is_long_video or not has_1080p  # Recommended for long videos
+                fmt['estimated_size'] = self._estimate_file_size(duration, 720)
+                formats.append(fmt)
             
             if has_480p:
-                formats.append({
-                    'format_id': 'best[height>=480]',
-                    'quality': 'HD (480p) - Good Quality ⚡ Fastest download',
-                    'height': 480,
-                    'width': 854,
-                    'ext': 'mp4',
-                    'filesize': 0,
-                    'fps': 30,
-                    'has_audio': True,
-                    'vcodec': 'h264',
-                    'acodec': 'aac',
-                    'recommended': False,
-                    'estimated_size': self._estimate_file_size(duration, 480)
-                })
+                fmt = _FORMAT_TEMPLATES[480].copy()
+                fmt['recommended'] = False
+                fmt['estimated_size'] = self._estimate_file_size(duration, 480)
+                formats.append(fmt)
             
             # Always add best available
-            formats.append({
-                'format_id': 'best',
-                'quality': 'Best Available Quality (Auto) 🔄 Adaptive',
-                'height': 720,
-                'width': 1280,
-                'ext': 'mp4',
-                'filesize': 0,
-                'fps': 30,
-                'has_audio': True,
-                'vcodec': 'h264',
-                'acodec': 'aac',
-                'recommended': len(formats) == 0,
-                'estimated_size': self._estimate_file_size(duration, 720)
-            })
+            fmt = _FORMAT_TEMPLATES['best'].copy()
+            fmt['recommended'] = len(formats) == 0
+            fmt['estimated_size'] = self._estimate_file_size(duration, 720)
+            formats.append(fmt)
             
             # Add audio option
-            formats.append({
-                'format_id': 'bestaudio',
-                'quality': '🎵 Audio Only (320kbps MP3) 📱 Mobile friendly',
-                'height': 0,
-                'width': 0,
-                'ext': 'mp3',
-                'filesize': 0,
-                'fps': 0,
-                'has_audio': True,
-                'vcodec': 'none',
-                'acodec': 'mp3',
-                'estimated_size': self._estimate_audio_size(duration)
-            })
+            fmt = _FORMAT_TEMPLATES['audio'].copy()
+            fmt['estimated_size'] = self._estimate_audio_size(duration)
+            formats.append(fmt)
             
             video_info['formats'] = formats
             logger.info(f"Processed {len(formats)} formats")
@@ -433,9 +663,8 @@ class YouTubeDownloader:
         if not seconds:
             return "Unknown"
         
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        seconds = seconds % 60
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
         
         if hours > 0:
             return f"{hours}h {minutes}m {seconds}s"
@@ -449,20 +678,8 @@ class YouTubeDownloader:
         if not duration:
             return "Unknown"
         
-        # Rough estimates in MB per minute
-        bitrates = {
-            1080: 8,   # 8 MB per minute
-            720: 5,    # 5 MB per minute  
-            480: 3     # 3 MB per minute
-        }
-        
-        bitrate = bitrates.get(height, 5)
-        size_mb = (duration / 60) * bitrate
-        
-        if size_mb > 1024:
-            return f"~{size_mb/1024:.1f} GB"
-        else:
-            return f"~{size_mb:.0f} MB"
+        size_mb = duration * _BITRATES.get(height, 5) / 60
+        return f"~{size_mb/1024:.1f} GB" if size_mb > 1024 else f"~{size_mb:.0f} MB"
     
     def _estimate_audio_size(self, duration):
         """Estimate audio file size"""
@@ -470,33 +687,22 @@ class YouTubeDownloader:
             return "Unknown"
         
         # 320kbps MP3 = ~2.4 MB per minute
-        size_mb = (duration / 60) * 2.4
-        
-        if size_mb > 1024:
-            return f"~{size_mb/1024:.1f} GB"
-        else:
-            return f"~{size_mb:.0f} MB"
-    
-    def _extract_info_sync(self, url, ydl_opts):
-        """Synchronous info extraction for thread pool"""
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=False)
+        size_mb = duration * 2.4 / 60
+        return f"~{size_mb/1024:.1f} GB" if size_mb > 1024 else f"~{size_mb:.0f} MB"
     
     async def download_video_async(self, task_id: str, url: str, format_id: str, quality: str):
         """Download video asynchronously with enhanced support for long videos"""
+        if self.download_semaphore.locked():
+            task_manager.update_task(
+                task_id,
+                status=TaskStatus.PENDING,
+                message="Waiting for download slot..."
+            )
+        
         async with self.download_semaphore:  # Limit concurrent downloads
+            self.active_downloads += 1
+            temp_dir = None
             try:
-                # Wait if too many downloads are active
-                while not task_manager.can_start_download():
-                    task_manager.update_task(
-                        task_id,
-                        status=TaskStatus.PENDING,
-                        message="Waiting for download slot..."
-                    )
-                    await asyncio.sleep(5)
-                
-                task_manager.increment_active_downloads()
-                
                 task_manager.update_task(
                     task_id, 
                     status=TaskStatus.PROCESSING,
@@ -505,18 +711,14 @@ class YouTubeDownloader:
                 )
                 
                 # Clean URL
-                video_id = self.extract_video_id(url)
-                if video_id:
-                    clean_url = f"https://www.youtube.com/watch?v={video_id}"
-                else:
-                    clean_url = url
+                video_id, clean_url = self.clean_url(url)
                 
                 logger.info(f"Downloading: {clean_url}")
                 logger.info(f"Format: {format_id}")
                 logger.info(f"Quality: {quality}")
                 
-                # Generate unique filename
-                unique_id = str(uuid.uuid4())[:8]
+                # Task IDs are already uuid4s, reuse one for the temp filename
+                unique_id = task_id[:8]
                 
                 task_manager.update_task(
                     task_id,
@@ -524,20 +726,51 @@ class YouTubeDownloader:
                     message="Preparing download..."
                 )
                 
-                # Run download in thread pool
-                loop = asyncio.get_event_loop()
-                filename = await loop.run_in_executor(
-                    None,
-                    self._download_video_sync,
-                    clean_url,
-                    format_id,
-                    quality,
-                    unique_id,
-                    task_id
-                )
+                # Reuse metadata from /extract when available
+                metadata = get_cached_video_info(video_id) if video_id else None
+                if metadata is None:
+                    info_opts = {
+                        'quiet': True,
+                        'no_warnings': True,
+                        'socket_timeout': 60,
+                        'extractor_args': _EXTRACTOR_ARGS,
+                    }
+                    async with _extract_sem:
+                        info = await run_in_pool(
+                            'extract_pool',
+                            _extract_info_sync,
+                            clean_url,
+                            info_opts,
+                            retry=True
+                        )
+                    metadata = (info.get('title'), info.get('duration') or 0)
+                    if video_id:
+                        cache_video_info(video_id, *metadata)
+                title, duration = metadata
+                
+                # Run download in its own worker process
+                temp_dir = file_manager.create_temp_dir(task_id)
+                progress_queue = app.state.progress_manager.Queue()
+                drain = asyncio.create_task(_drain_progress(task_id, progress_queue))
+                try:
+                    filename, file_size = await run_isolated(
+                        _download_video_sync,
+                        clean_url,
+                        format_id,
+                        quality,
+                        unique_id,
+                        temp_dir,
+                        title,
+                        duration,
+                        bandwidth_estimator.chunk_size(),
+                        progress_queue
+                    )
+                finally:
+                    progress_queue.put(None)
+                    await drain
                 
                 # Register file for proper cleanup
-                file_manager.register_file(task_id, filename, os.path.dirname(filename))
+                file_manager.register_file(task_id, filename, os.path.dirname(filename), file_size)
                 
                 download_url = f"/download-file/{task_id}"
                 
@@ -556,6 +789,10 @@ class YouTubeDownloader:
             except Exception as e:
                 logger.error(f"Download error for task {task_id}: {str(e)}")
                 error_msg = str(e)
+                if temp_dir:
+                    # Partial fragments can number in the thousands; delete
+                    # them in the background rather than on the event loop
+                    asyncio.get_event_loop().run_in_executor(None, file_manager.discard_temp_dir, temp_dir)
                 
                 # Enhanced error handling for long videos
                 if "Sign in to confirm you're not a bot" in error_msg:
@@ -568,6 +805,8 @@ class YouTubeDownloader:
                     error_msg = "Connection timeout. This may happen with very long videos. Please try again."
                 elif "No space left on device" in error_msg:
                     error_msg = "Server storage full. Please try again later."
+                elif isinstance(e, BrokenProcessPool):
+                    error_msg = "The download worker crashed (possibly out of memory). Please try again or choose a lower quality."
                 
                 task_manager.update_task(
                     task_id,
@@ -579,308 +818,385 @@ class YouTubeDownloader:
                 raise Exception(error_msg)
             
             finally:
-                task_manager.decrement_active_downloads()
-    
-    def _download_video_sync(self, url, format_id, quality, unique_id, task_id):
-        """Synchronous download optimized for long videos"""
-        temp_dir = None
-        try:
-            # Create temporary directory
-            temp_dir = tempfile.mkdtemp(prefix='youtube_dl_long_')
-            
-            def progress_hook(d):
-                if d['status'] == 'downloading':
+                self.active_downloads -= 1
+
+def _download_video_sync(url, format_id, quality, unique_id, temp_dir, title, duration, chunk_size, progress_queue):
+    """Synchronous download optimized for long videos (runs in a worker process)"""
+    # Task updates go through progress_queue; the parent applies them and
+    # removes temp_dir if the download fails
+    last_update = [0.0]
+
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            # Throttle to one update per PROGRESS_UPDATE_INTERVAL, but
+            # always let the final tick of a file through
+            now = time.monotonic()
+            if (now - last_update[0] < PROGRESS_UPDATE_INTERVAL
+                    and d.get('downloaded_bytes') != d.get('total_bytes')):
+                return
+            last_update[0] = now
+            try:
+                # Enhanced progress tracking for long videos
+                if 'total_bytes' in d and d['total_bytes']:
+                    progress = int((d['downloaded_bytes'] / d['total_bytes']) * 80) + 15  # 15-95%
+                    speed = d.get('speed', 0)
+                    eta = d.get('eta', 0)
+
+                    # Format speed
+                    if speed:
+                        if speed > 1024 * 1024:
+                            speed_str = f"{speed / (1024 * 1024):.1f} MB/s"
+                        elif speed > 1024:
+                            speed_str = f"{speed / 1024:.1f} KB/s"
+                        else:
+                            speed_str = f"{speed:.0f} B/s"
+                    else:
+                        speed_str = "0 B/s"
+
+                    # Format ETA
+                    if eta:
+                        eta_str = downloader._format_duration(eta)
+                    else:
+                        eta_str = "Unknown"
+
+                    progress_queue.put(dict(
+                        progress=min(progress, 95),
+                        message=f"Downloading... {d.get('_percent_str', '50%')}",
+                        download_speed=speed_str,
+                        eta=eta_str,
+                        downloaded_bytes=d['downloaded_bytes'],
+                        total_bytes=d['total_bytes']
+                    ))
+                elif '_percent_str' in d:
+                    percent_str = d['_percent_str'].replace('%', '')
                     try:
-                        # Enhanced progress tracking for long videos
-                        if 'total_bytes' in d and d['total_bytes']:
-                            progress = int((d['downloaded_bytes'] / d['total_bytes']) * 80) + 15  # 15-95%
-                            speed = d.get('speed', 0)
-                            eta = d.get('eta', 0)
-                            
-                            # Format speed
-                            if speed:
-                                if speed > 1024 * 1024:
-                                    speed_str = f"{speed / (1024 * 1024):.1f} MB/s"
-                                elif speed > 1024:
-                                    speed_str = f"{speed / 1024:.1f} KB/s"
-                                else:
-                                    speed_str = f"{speed:.0f} B/s"
-                            else:
-                                speed_str = "0 B/s"
-                            
-                            # Format ETA
-                            if eta:
-                                eta_str = self._format_duration(eta)
-                            else:
-                                eta_str = "Unknown"
-                            
-                            task_manager.update_task(
-                                task_id,
-                                progress=min(progress, 95),
-                                message=f"Downloading... {d.get('_percent_str', '50%')}",
-                                download_speed=speed_str,
-                                eta=eta_str,
-                                downloaded_bytes=d['downloaded_bytes'],
-                                total_bytes=d['total_bytes']
-                            )
-                        elif '_percent_str' in d:
-                            percent_str = d['_percent_str'].replace('%', '')
-                            try:
-                                progress = int(float(percent_str) * 0.8) + 15  # 15-95%
-                                task_manager.update_task(
-                                    task_id,
-                                    progress=min(progress, 95),
-                                    message=f"Downloading... {d.get('_percent_str', '50%')}"
-                                )
-                            except:
-                                pass
-                    except Exception as e:
-                        logger.error(f"Progress hook error: {e}")
+                        progress = int(float(percent_str) * 0.8) + 15  # 15-95%
+                        progress_queue.put(dict(
+                            progress=min(progress, 95),
+                            message=f"Downloading... {d.get('_percent_str', '50%')}"
+                        ))
+                    except:
                         pass
-                elif d['status'] == 'finished':
-                    task_manager.update_task(
-                        task_id,
-                        progress=98,
-                        message="Processing downloaded file..."
-                    )
-            
-            if 'Audio Only' in quality or format_id == 'bestaudio':
-                # MP3 AUDIO DOWNLOAD
-                temp_filename = f"audio_{unique_id}.%(ext)s"
-                
-                # ✅ OPTIMIZED AUDIO OPTIONS FOR LONG VIDEOS
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'outtmpl': os.path.join(temp_dir, temp_filename),
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '320',
-                    }],
-                    'quiet': False,
-                    'no_warnings': False,
-                    'progress_hooks': [progress_hook],
-                    'socket_timeout': 120,  # 2 minutes timeout
-                    'retries': 10,
-                    'fragment_retries': 15,
-                    'skip_unavailable_fragments': True,
-                    'keep_fragments': False,
-                    'http_chunk_size': 10485760,  # 10MB chunks
-                    'concurrent_fragment_downloads': 3,
-                }
-                
-                # Get title for final filename
-                info_opts = {'quiet': True, 'no_warnings': True, 'socket_timeout': 60}
-                with yt_dlp.YoutubeDL(info_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    title = info.get('title', 'YouTube Audio')
-                
-                final_filename = self.get_unique_filename(temp_dir, f"{title}_audio", 'mp3')
-            
-            else:
-                # VIDEO DOWNLOAD - OPTIMIZED FOR LONG VIDEOS
-                temp_filename = f"video_{unique_id}.%(ext)s"
-                
-                # Get title for final filename
-                info_opts = {'quiet': True, 'no_warnings': True, 'socket_timeout': 60}
-                with yt_dlp.YoutubeDL(info_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    title = info.get('title', 'YouTube Video')
-                    duration = info.get('duration', 0)
-                
-                final_filename = self.get_unique_filename(temp_dir, title, 'mp4')
-                
-                # ✅ ENHANCED FORMAT SELECTION FOR LONG VIDEOS
-                if format_id == 'best[height>=1080]':
-                    selected_format = (
-                        "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/"
-                        "bestvideo[height<=1080][ext=webm]+bestaudio[ext=webm]/"
-                        "best[height<=1080][ext=mp4]/best[height<=1080]/"
-                        "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/"
-                        "best[height<=720]/best"
-                    )
-                elif format_id == 'best[height>=720]':
-                    selected_format = (
-                        "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/"
-                        "bestvideo[height<=720][ext=webm]+bestaudio[ext=webm]/"
-                        "best[height<=720][ext=mp4]/best[height<=720]/"
-                        "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/"
-                        "best[height<=480]/best"
-                    )
-                elif format_id == 'best[height>=480]':
-                    selected_format = (
-                        "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/"
-                        "bestvideo[height<=480][ext=webm]+bestaudio[ext=webm]/"
-                        "best[height<=480][ext=mp4]/best[height<=480]/"
-                        "best"
-                    )
-                else:
-                    selected_format = (
-                        "bestvideo[ext=mp4]+bestaudio[ext=m4a]/"
-                        "bestvideo[ext=webm]+bestaudio[ext=webm]/"
-                        "best[ext=mp4]/best"
-                    )
-                
-                # ✅ OPTIMIZED YT-DLP OPTIONS FOR LONG VIDEOS
-                ydl_opts = {
-                    'format': selected_format,
-                    'outtmpl': os.path.join(temp_dir, temp_filename),
-                    'merge_output_format': 'mp4',
-                    'quiet': False,
-                    'no_warnings': False,
-                    'progress_hooks': [progress_hook],
-                    
-                    # ✅ ENHANCED SETTINGS FOR LONG VIDEOS
-                    'socket_timeout': 300,  # 5 minutes timeout
-                    'http_chunk_size': 20971520,  # 20MB chunks for large files
-                    'fragment_retries': 20,  # More retries for long videos
-                    'retries': 15,
-                    'file_access_retries': 5,
-                    'skip_unavailable_fragments': True,
-                    'keep_fragments': False,
-                    'concurrent_fragment_downloads': 4,  # More concurrent downloads
-                    
-                    # Connection stability
-                    'http_headers': {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    },
-                    
-                    # Post-processing
-                    'prefer_ffmpeg': True,
-                    'postprocessors': [{
-                        'key': 'FFmpegVideoConvertor',
-                        'preferedformat': 'mp4',
-                    }] if not temp_filename.endswith('.mp4') else [],
-                }
-                
-                # Adjust settings based on video duration
-                if duration > 7200:  # More than 2 hours
-                    ydl_opts.update({
-                        'socket_timeout': 600,  # 10 minutes timeout
-                        'http_chunk_size': 52428800,  # 50MB chunks
-                        'fragment_retries': 30,
-                        'retries': 20,
-                        'concurrent_fragment_downloads': 2,  # Fewer concurrent for stability
-                    })
-                    logger.info("Applied long video optimizations (2+ hours)")
-                elif duration > 3600:  # More than 1 hour
-                    ydl_opts.update({
-                        'socket_timeout': 450,  # 7.5 minutes timeout
-                        'http_chunk_size': 31457280,  # 30MB chunks
-                        'fragment_retries': 25,
-                        'retries': 18,
-                    })
-                    logger.info("Applied medium video optimizations (1+ hour)")
-            
-            logger.info(f"Using format: {ydl_opts.get('format', 'default')}")
-            logger.info(f"Chunk size: {ydl_opts.get('http_chunk_size', 0) / 1024 / 1024:.1f} MB")
-            
-            # Download the video/audio with retry mechanism
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([url])
-                    break  # Success, exit retry loop
-                except Exception as e:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Download attempt {attempt + 1} failed: {e}. Retrying...")
-                        task_manager.update_task(
-                            task_id,
-                            message=f"Retrying download... (Attempt {attempt + 2}/{max_retries})"
-                        )
-                        time.sleep(10)  # Wait before retry
-                    else:
-                        raise e
-            
-            # Find the downloaded file
-            temp_path = None
-            for file in os.listdir(temp_dir):
-                if unique_id in file:
-                    temp_path = os.path.join(temp_dir, file)
-                    break
-            
-            if not temp_path or not os.path.exists(temp_path):
-                # Try to find any recently created file
-                files = []
-                for file in os.listdir(temp_dir):
-                    file_path = os.path.join(temp_dir, file)
-                    if os.path.getctime(file_path) > time.time() - 1800:  # Created in last 30 minutes
-                        files.append((file_path, os.path.getctime(file_path)))
-                
-                if files:
-                    # Get the most recently created file
-                    files.sort(key=lambda x: x[1], reverse=True)
-                    temp_path = files[0][0]
+            except Exception as e:
+                logger.error(f"Progress hook error: {e}")
+                pass
+        elif d['status'] == 'finished':
+            progress_queue.put(dict(
+                progress=98,
+                message="Processing downloaded file...",
+                throughput=(d.get('total_bytes') or d.get('downloaded_bytes'), d.get('elapsed'))
+            ))
+
+    is_audio = 'Audio Only' in quality or format_id == 'bestaudio'
+    if is_audio:
+        # MP3 AUDIO DOWNLOAD
+        temp_filename = f"audio_{unique_id}.%(ext)s"
+
+        # ✅ OPTIMIZED AUDIO OPTIONS FOR LONG VIDEOS
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(temp_dir, temp_filename),
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '320',
+            }],
+            'quiet': False,
+            'no_warnings': False,
+            'progress_hooks': [progress_hook],
+            'socket_timeout': 120,  # 2 minutes timeout
+            'retries': 10,
+            'fragment_retries': 15,
+            'skip_unavailable_fragments': True,
+            'keep_fragments': False,
+            'http_chunk_size': 10485760,  # 10MB chunks
+            'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+
+            # Connection stability
+            'http_headers': {'User-Agent': random.choice(_UA_POOL)},
+            'extractor_args': _EXTRACTOR_ARGS,
+        }
+
+        final_filename = downloader.get_unique_filename(f"{title or 'YouTube Audio'}_audio", 'mp3')
+
+    else:
+        # VIDEO DOWNLOAD - OPTIMIZED FOR LONG VIDEOS
+        temp_filename = f"video_{unique_id}.%(ext)s"
+
+        final_filename = downloader.get_unique_filename(title or 'YouTube Video', 'mp4')
+
+        # ✅ ENHANCED FORMAT SELECTION FOR LONG VIDEOS
+        if format_id == 'best[height>=1080]':
+            selected_format = (
+                "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/"
+                "bestvideo[height<=1080][ext=webm]+bestaudio[ext=webm]/"
+                "best[height<=1080][ext=mp4]/best[height<=1080]/"
+                "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/"
+                "best[height<=720]/best"
+            )
+        elif format_id == 'best[height>=720]':
+            selected_format = (
+                "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/"
+                "bestvideo[height<=720][ext=webm]+bestaudio[ext=webm]/"
+                "best[height<=720][ext=mp4]/best[height<=720]/"
+                "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/"
+                "best[height<=480]/best"
+            )
+        elif format_id == 'best[height>=480]':
+            selected_format = (
+                "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/"
+                "bestvideo[height<=480][ext=webm]+bestaudio[ext=webm]/"
+                "best[height<=480][ext=mp4]/best[height<=480]/"
+                "best"
+            )
+        else:
+            selected_format = (
+                "bestvideo[ext=mp4]+bestaudio[ext=m4a]/"
+                "bestvideo[ext=webm]+bestaudio[ext=webm]/"
+                "best[ext=mp4]/best"
+            )
+
+        # ✅ OPTIMIZED YT-DLP OPTIONS FOR LONG VIDEOS
+        ydl_opts = {
+            'format': selected_format,
+            'outtmpl': os.path.join(temp_dir, temp_filename),
+            # ffmpeg merges video+audio in one stream-copy pass straight to
+            # mp4; the per-format inputs are deleted together afterwards
+            'merge_output_format': 'mp4',
+            'keepvideo': False,
+            'quiet': False,
+            'no_warnings': False,
+            'progress_hooks': [progress_hook],
+
+            # ✅ ENHANCED SETTINGS FOR LONG VIDEOS
+            'socket_timeout': 300,  # 5 minutes timeout
+            'http_chunk_size': 20971520,  # 20MB chunks for large files
+            'fragment_retries': 20,  # More retries for long videos
+            'retries': 15,
+            'file_access_retries': 5,
+            'skip_unavailable_fragments': True,
+            'keep_fragments': False,
+            'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+
+            # Connection stability
+            'http_headers': {'User-Agent': random.choice(_UA_POOL)},
+            'extractor_args': _EXTRACTOR_ARGS,
+
+            # Post-processing: the remux to mp4 runs after the download
+            # (see _remux_to_mp4)
+            'prefer_ffmpeg': True,
+        }
+
+        # Adjust settings based on video duration
+        if duration > 7200:  # More than 2 hours
+            ydl_opts.update({
+                'socket_timeout': 600,  # 10 minutes timeout
+                'http_chunk_size': 52428800,  # 50MB chunks
+                'fragment_retries': 30,
+                'retries': 20,
+                # Per-fragment retries above handle stability
+                'concurrent_fragment_downloads': min(CONCURRENT_FRAGMENTS, 8),
+            })
+            logger.info("Applied long video optimizations (2+ hours)")
+        elif duration > 3600:  # More than 1 hour
+            ydl_opts.update({
+                'socket_timeout': 450,  # 7.5 minutes timeout
+                'http_chunk_size': 31457280,  # 30MB chunks
+                'fragment_retries': 25,
+                'retries': 18,
+            })
+            logger.info("Applied medium video optimizations (1+ hour)")
+
+    # Measured throughput overrides the static chunk size defaults
+    if chunk_size:
+        ydl_opts['http_chunk_size'] = chunk_size
+
+    logger.info(f"Using format: {ydl_opts.get('format', 'default')}")
+    logger.info(f"Chunk size: {ydl_opts.get('http_chunk_size', 0) / 1024 / 1024:.1f} MB")
+
+    # Download the video/audio with retry mechanism
+    # One YoutubeDL instance serves every attempt; options are per task
+    # (progress hook, temp dir), so it isn't shared beyond this download
+    max_retries = 3
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    try:
+        for attempt in range(max_retries):
+            try:
+                info = ydl.extract_info(url, download=True)
+                requested = info.get('requested_downloads') or []
+                download = requested[-1] if requested else None
+                break  # Success, exit retry loop
+            except Exception as e:
+                # yt-dlp wraps the original error in a DownloadError
+                cause = e.exc_info[1] if getattr(e, 'exc_info', None) else e
+                if attempt < max_retries - 1:
+                    logger.warning(f"Download attempt {attempt + 1} failed: {e}. Retrying...")
+                    progress_queue.put(dict(
+                        message=f"Retrying download... (Attempt {attempt + 2}/{max_retries})"
+                    ))
+                    time.sleep(_retry_delay(attempt, cause))  # Wait before retry
                 else:
-                    raise Exception("Downloaded file not found")
-            
-            # Rename to final filename
-            final_path = os.path.join(temp_dir, final_filename)
-            
-            # Remove target file if it exists
-            if os.path.exists(final_path):
-                os.remove(final_path)
-            
-            os.rename(temp_path, final_path)
-            
-            # Verify file size
-            file_size = os.path.getsize(final_path)
-            logger.info(f"Download completed: {final_filename} ({file_size / 1024 / 1024:.1f} MB)")
-            
-            return final_path  # Return full path
-        
-        except Exception as e:
-            # Cleanup on error
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                except:
-                    pass
-            raise e
+                    raise e
+
+        if download is not None and not is_audio:
+            download = _remux_to_mp4(ydl, download)
+        # yt-dlp reports the final path (after any post-processor
+        # extension change), so temp_dir never needs scanning
+        temp_path = download.get('filepath') if download else None
+        if not temp_path:
+            temp_path = ydl.prepare_filename(info)
+    finally:
+        ydl.close()
+
+    if not temp_path:
+        raise Exception("Downloaded file not found")
+
+    # Rename to final filename (os.replace overwrites atomically, so no
+    # existence probe or separate remove is needed)
+    final_path = os.path.join(temp_dir, final_filename)
+    try:
+        os.replace(temp_path, final_path)
+    except FileNotFoundError:
+        raise Exception("Downloaded file not found")
+
+    # Stat the final file once: yt-dlp's reported size predates
+    # post-processing (mp3 conversion, remux) and can be far off
+    file_size = os.stat(final_path).st_size
+    logger.info(f"Download completed: {final_filename} ({file_size / 1024 / 1024:.1f} MB)")
+
+    return final_path, file_size  # Full path and size on disk
+
+def _remux_to_mp4(ydl, download):
+    """Remux a finished video download to MP4, re-encoding if it can't be"""
+    # Run explicitly rather than as a registered post-processor so only a
+    # failed remux (not a merge or fixup error) triggers the conversion,
+    # which then works on the file already on disk
+    try:
+        return ydl.run_pp(yt_dlp.postprocessor.FFmpegVideoRemuxerPP(ydl, preferedformat='mp4'), download)
+    except yt_dlp.utils.PostProcessingError as e:
+        # Codecs can't be stored in MP4 as-is
+        logger.warning(f"Remux to mp4 failed: {e}. Converting instead...")
+        return ydl.run_pp(yt_dlp.postprocessor.FFmpegVideoConvertorPP(ydl, preferedformat='mp4'), download)
+
+def _retry_delay(attempt, error):
+    """Seconds to wait before retrying a failed download attempt"""
+    # Honor the server's Retry-After on HTTP 429 instead of hammering it
+    error = getattr(error, 'cause', None) or error  # Unwrap ExtractorError
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    if status == 429:
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+        retry_after = str(headers.get('Retry-After', ''))
+        if retry_after.isdigit():
+            return min(int(retry_after), MAX_RETRY_AFTER)
+    
+    # Exponential backoff (1, 2, 4, ... seconds) with +/-20% jitter
+    return min(MAX_RETRY_DELAY, (2 ** attempt) * (0.8 + 0.4 * random.random()))
+
+async def _drain_progress(task_id, progress_queue):
+    """Apply task updates sent by a download worker until a None sentinel"""
+    loop = asyncio.get_event_loop()
+    while True:
+        update = await loop.run_in_executor(None, progress_queue.get)
+        if update is None:
+            break
+        throughput = update.pop('throughput', None)
+        if throughput:
+            bandwidth_estimator.record(*throughput)
+        task_manager.update_task(task_id, **update)
+
+SYSTEM_SNAPSHOT_TTL = 2  # Seconds to reuse memory/disk readings
+_system_snapshot = (0.0, None)
+
+def system_snapshot():
+    """Get (virtual_memory, disk_usage), refreshed at most every SYSTEM_SNAPSHOT_TTL"""
+    global _system_snapshot
+    taken_at, snapshot = _system_snapshot
+    now = time.monotonic()
+    if snapshot is None or now - taken_at > SYSTEM_SNAPSHOT_TTL:
+        snapshot = (psutil.virtual_memory(), psutil.disk_usage('/'))
+        _system_snapshot = (now, snapshot)
+    return snapshot
 
 # ✅ ENHANCED CLEANUP FOR LONG VIDEOS
-async def cleanup_temp_files():
-    """Background task to clean up temporary files"""
+CLEANUP_INTERVAL = 120  # Check every 2 minutes
+
+def run_cleanup():
+    """Clean up old tasks and temporary files (blocking, does disk I/O)"""
+    task_manager.cleanup_old_tasks()
+    file_manager.sweep()
+    
+    # Additional system cleanup for long video downloads
+    # Check system memory and disk space
+    memory, disk = system_snapshot()
+    
+    if memory.percent > 85:
+        logger.warning(f"High memory usage: {memory.percent}%")
+    
+    if disk.percent > 90:
+        logger.warning(f"High disk usage: {disk.percent}%")
+        # Force cleanup of old files
+        file_manager.max_file_age = 1800  # Reduce to 30 minutes
+    else:
+        file_manager.max_file_age = 3600  # Reset to 1 hour
+
+async def cleanup_loop():
+    """Single periodic background task for all cleanup"""
+    loop = asyncio.get_event_loop()
     while True:
         try:
-            file_manager.cleanup_old_files()
-            
-            # Additional system cleanup for long video downloads
-            # Check system memory and disk space
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
-            
-            if memory.percent > 85:
-                logger.warning(f"High memory usage: {memory.percent}%")
-            
-            if disk.percent > 90:
-                logger.warning(f"High disk usage: {disk.percent}%")
-                # Force cleanup of old files
-                file_manager.max_file_age = 1800  # Reduce to 30 minutes
-            else:
-                file_manager.max_file_age = 3600  # Reset to 1 hour
-            
-            await asyncio.sleep(120)  # Check every 2 minutes
+            await loop.run_in_executor(None, run_cleanup)
         except Exception as e:
             logger.error(f"Cleanup task error: {e}")
-            await asyncio.sleep(120)
+        await asyncio.sleep(CLEANUP_INTERVAL)
+
+# Process pools live on app.state (see startup_event); sizes by attribute
+POOL_SIZES = {
+    'extract_pool': EXTRACT_WORKERS,
+}
+
+async def run_in_pool(pool_name, func, *args, retry=False):
+    """Run func in an app.state process pool, replacing the pool if a worker died"""
+    loop = asyncio.get_event_loop()
+    pool = getattr(app.state, pool_name)
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker killed mid-job (e.g. by the OOM killer) marks the executor
+        # broken for good, so swap in a fresh one for later jobs. Concurrent
+        # failures from the same pool only replace it once.
+        if getattr(app.state, pool_name) is pool:
+            logger.error(f"Worker in {pool_name} died, recreating the pool")
+            setattr(app.state, pool_name, ProcessPoolExecutor(max_workers=POOL_SIZES[pool_name]))
+            pool.shutdown(wait=False, cancel_futures=True)
+        if not retry:
+            raise
+    return await loop.run_in_executor(getattr(app.state, pool_name), func, *args)
+
+async def run_isolated(func, *args):
+    """Run func in a dedicated single-use worker process"""
+    # A shared pool breaks every pending job when one worker dies (e.g. OOM
+    # killed on a 10h video); with one executor per download a crash only
+    # fails its own task. Concurrency is bounded by download_semaphore.
+    loop = asyncio.get_event_loop()
+    executor = ProcessPoolExecutor(max_workers=1)
+    try:
+        return await loop.run_in_executor(executor, func, *args)
+    finally:
+        executor.shutdown(wait=False)
 
 # Initialize downloader
 downloader = YouTubeDownloader()
 
-# Background task for cleanup
-async def cleanup_task():
-    """Periodic cleanup of old tasks"""
-    while True:
-        await asyncio.sleep(1800)  # Run every 30 minutes
-        task_manager.cleanup_old_tasks()
-
 # Start cleanup task on startup
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(cleanup_task())
-    asyncio.create_task(cleanup_temp_files())
+    # Process pools are started here rather than at import so each server
+    # worker gets exactly one set, with an explicit shutdown below
+    # Downloads each get their own process instead (see run_isolated)
+    app.state.extract_pool = ProcessPoolExecutor(max_workers=POOL_SIZES['extract_pool'])
+    app.state.progress_manager = multiprocessing.Manager()
+    app.state.cleanup_task = asyncio.create_task(cleanup_loop())
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -996,27 +1312,31 @@ async def get_task_status(task_id: str):
     }
 
 @app.get("/tasks")
-async def get_all_tasks():
-    """Get all tasks (for debugging/monitoring)"""
+async def get_all_tasks(limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0)):
+    """Get tasks, oldest first, one page at a time (for debugging/monitoring)"""
     return {
         'success': True,
-        'tasks': list(task_manager.tasks.values()),
+        'tasks': task_manager.list_tasks(limit, offset),
         'total_tasks': len(task_manager.tasks),
-        'active_downloads': task_manager.active_downloads
+        'limit': limit,
+        'offset': offset,
+        'active_downloads': downloader.active_downloads
     }
 
 @app.delete("/task/{task_id}")
 async def delete_task(task_id: str):
     """Delete a specific task"""
-    if task_id not in task_manager.tasks:
+    if not task_manager.delete_task(task_id):
         raise HTTPException(status_code=404, detail="Task not found")
     
-    del task_manager.tasks[task_id]
     return {'success': True, 'message': 'Task deleted successfully'}
 
+class LargeFileResponse(FileResponse):
+    chunk_size = 1024 * 1024  # 1 MiB reads instead of Starlette's 64 KiB
+
 # ✅ ENHANCED FILE DOWNLOAD WITH STREAMING FOR LARGE FILES
 @app.get("/download-file/{task_id}")
-async def download_file(task_id: str):
+async def download_file(task_id: str, request: Request):
     """Download file with streaming support for large files"""
     try:
         file_info = file_manager.get_file_info(task_id)
@@ -1027,42 +1347,39 @@ async def download_file(task_id: str):
         file_path = file_info['file_path']
         filename = file_info['filename']
         
-        if not os.path.exists(file_path):
+        # One stat both checks the file exists and feeds FileResponse's
+        # Content-Length/Last-Modified headers
+        try:
+            stat_result = os.stat(file_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="File not found on disk")
         
         # Mark as downloaded for cleanup
         file_manager.mark_downloaded(task_id)
         
-        # Determine content type
-        content_type = "video/mp4"
-        if filename.endswith('.mp3'):
-            content_type = "audio/mpeg"
-        elif filename.endswith('.webm'):
-            content_type = "video/webm"
-        
-        # Get file size
-        file_size = os.path.getsize(file_path)
-        
         # ✅ USE FileResponse FOR PROPER LARGE FILE SERVING
-        response = FileResponse(
+        # Streams from disk in chunks (never buffers the whole file) with
+        # an explicit Content-Length instead of chunked transfer encoding
+        response = LargeFileResponse(
             path=file_path,
             filename=filename,
-            media_type=content_type,
+            media_type=file_info['content_type'],
+            stat_result=stat_result,
             headers={
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Methods": "GET",
                 "Access-Control-Allow-Headers": "*",
-                "Content-Length": str(file_size),
                 "Accept-Ranges": "bytes",
+                "X-Accel-Buffering": "no",  # Don't let proxies re-buffer the file
             }
         )
         
-        # Schedule cleanup after download
-        async def cleanup_after_download():
-            await asyncio.sleep(30)  # Wait 30 seconds after response for large files
-            file_manager.cleanup_file(task_id)
-        
-        asyncio.create_task(cleanup_after_download())
+        # Clean up once the full file has been sent (Starlette runs sync
+        # background tasks in its thread pool, off the event loop). Range
+        # requests only fetch part of it and may be followed by more, so
+        # those files are left to cleanup_old_files instead.
+        if 'range' not in request.headers:
+            response.background = BackgroundTask(file_manager.cleanup_file, task_id)
         
         return response
     
@@ -1075,8 +1392,7 @@ async def download_file(task_id: str):
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    memory, disk = system_snapshot()
     
     return {
         'status': 'OK',
@@ -1089,10 +1405,10 @@ async def health_check():
             'Memory and disk monitoring'
         ],
         'timestamp': datetime.now().isoformat(),
-        'active_tasks': len([t for t in task_manager.tasks.values() if t['status'] == TaskStatus.PROCESSING]),
+        'active_tasks': task_manager.status_count(TaskStatus.PROCESSING),
         'total_tasks': len(task_manager.tasks),
         'temp_files': len(file_manager._files),
-        'active_downloads': task_manager.active_downloads,
+        'active_downloads': downloader.active_downloads,
         'system': {
             'memory_usage': f"{memory.percent}%",
             'disk_usage': f"{disk.percent}%",
@@ -1104,18 +1420,16 @@ async def health_check():
 @app.get("/stats")
 async def get_stats():
     """Get system statistics"""
-    tasks = list(task_manager.tasks.values())
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    memory, disk = system_snapshot()
     
     stats = {
-        'total_tasks': len(tasks),
-        'pending_tasks': len([t for t in tasks if t['status'] == TaskStatus.PENDING]),
-        'processing_tasks': len([t for t in tasks if t['status'] == TaskStatus.PROCESSING]),
-        'completed_tasks': len([t for t in tasks if t['status'] == TaskStatus.COMPLETED]),
-        'failed_tasks': len([t for t in tasks if t['status'] == TaskStatus.FAILED]),
+        'total_tasks': len(task_manager.tasks),
+        'pending_tasks': task_manager.status_count(TaskStatus.PENDING),
+        'processing_tasks': task_manager.status_count(TaskStatus.PROCESSING),
+        'completed_tasks': task_manager.status_count(TaskStatus.COMPLETED),
+        'failed_tasks': task_manager.status_count(TaskStatus.FAILED),
         'temp_files': len(file_manager._files),
-        'active_downloads': task_manager.active_downloads,
+        'active_downloads': downloader.active_downloads,
         'max_concurrent_downloads': task_manager.max_concurrent_downloads,
         'system_resources': {
             'memory_percent': memory.percent,
@@ -1134,16 +1448,22 @@ async def shutdown_event():
     """Graceful shutdown"""
     logger.info("Shutting down gracefully...")
     
+    app.state.cleanup_task.cancel()
+    
     # Wait for active downloads to complete (max 5 minutes)
     shutdown_timeout = 300  # 5 minutes
     start_time = time.time()
     
-    while task_manager.active_downloads > 0 and (time.time() - start_time) < shutdown_timeout:
-        logger.info(f"Waiting for {task_manager.active_downloads} active downloads to complete...")
+    while downloader.active_downloads > 0 and (time.time() - start_time) < shutdown_timeout:
+        logger.info(f"Waiting for {downloader.active_downloads} active downloads to complete...")
         await asyncio.sleep(10)
     
+    app.state.extract_pool.shutdown(wait=False, cancel_futures=True)
+    app.state.progress_manager.shutdown()
+    
     # Force cleanup
-    file_manager.cleanup_old_files()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, file_manager.cleanup_old_files)
     logger.info("Shutdown complete")
 
 if __name__ == '__main__':